@@ -1,13 +1,23 @@
 import re
 from datetime import datetime
-from typing import Optional, Dict, List, Tuple
+from typing import Optional, Dict, List, Tuple, Iterator, Callable, Set
 import json
 import os
+import sys
+import time
+import hashlib
+import functools
+import unicodedata
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
-import pandas as pd
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from lxml import etree
+from google.oauth2.service_account import Credentials
+from googleapiclient.discovery import build, Resource
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from rapidfuzz import process, fuzz, utils
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -16,26 +26,119 @@ SPREADSHEET_NAME = "AISC Session Attendance 2025"
 SHEET_ATTENDEES = "attendees"
 SHEET_SESSIONS = "sessions"
 SHEET_ATTENDANCE_LOG = "attendee_log"
+API_RETRIES = 3
 
+# Ranges read up front in a single values.batchGet; the attendance log is
+# only ever appended to, so it is not fetched
+SHEET_RANGES = {
+    SHEET_ATTENDEES: f"{SHEET_ATTENDEES}!A:C",
+    SHEET_SESSIONS: f"{SHEET_SESSIONS}!A:A",
+}
 
-def setup_google_sheets() -> gspread.Client:
+# Id columns must hold plain values because ids are assigned client-side
+ID_RANGES = [f"{SHEET_ATTENDEES}!A:A", f"{SHEET_SESSIONS}!A:A"]
+
+LLM_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "_llm_cache.json")
+LLM_CACHE_TTL = 7 * 86400
+EXTRACTION_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+# Bump whenever the extractors change what they produce for the same file,
+# so sidecars written by an older parser are not reused
+EXTRACTION_CACHE_VERSION = 2
+
+MONTHS = {
+    month: i + 1
+    for i, month in enumerate(
+        ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+    )
+}
+QUIZ_DATE_RE = re.compile(r"\w{3}\s+(\d{1,2})\s+(\w{3})\s+(\d{4})")
+
+FUZZY_NAME_CUTOFF = 97
+
+XLSX_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+XLSX_REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+XLSX_PKG_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+XML_PARSER = etree.XMLParser(resolve_entities=False)
+
+EMAIL_QUESTION_RE = re.compile(r"e[-\s]?mail?", re.IGNORECASE)
+PARTICIPANT_COLUMN_RE = re.compile(r"^(.+?)\s+\(")
+PLACEHOLDER_NAMES = {"test", "hi", "ho", "average", "time", "question", "total"}
+LETTERS_RE = re.compile(r"[^\W\d_]{2,}")
+
+
+def _build_http_session() -> requests.Session:
+    retry = Retry(
+        total=3,
+        # Never retry a read timeout: the LLM POST has a 30s timeout and is
+        # billed per attempt, so only connection errors and statuses retry
+        read=0,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=None,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=4, max_retries=retry)
+    
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# Shared keep-alive session for the LLM calls; the Sheets and Drive clients
+# use googleapiclient's own transport
+_HTTP = _build_http_session()
+
+
+@functools.lru_cache(maxsize=1)
+def _google_credentials() -> Credentials:
     scope = [
-        "https://spreadsheets.google.com/feeds",
+        "https://www.googleapis.com/auth/spreadsheets",
         "https://www.googleapis.com/auth/drive"
     ]
     
-    creds = ServiceAccountCredentials.from_json_keyfile_name(
-        "/Users/rajani/Documents/GitHub/aisc_attendance/credentials.json",
-        scope
+    # GSPREAD_CREDS is still honoured for setups from before the move off gspread
+    creds_path = (
+        os.environ.get("GOOGLE_SERVICE_ACCOUNT_FILE")
+        or os.environ.get("GSPREAD_CREDS")
+        or os.path.join(os.path.dirname(os.path.abspath(__file__)), "credentials.json")
     )
-    
-    return gspread.authorize(creds)
+    return Credentials.from_service_account_file(creds_path, scopes=scope)
 
 
-def validate_names_with_llm(names: List[str]) -> List[str]:
-    if not names:
-        return []
+@functools.lru_cache(maxsize=1)
+def setup_google_sheets() -> Resource:
+    # Discovery documents ship with the client, so the service is built
+    # without a network fetch; disable the on-disk discovery cache as well
+    return build("sheets", "v4", credentials=_google_credentials(), cache_discovery=False)
+
+
+def find_spreadsheet_id() -> str:
+    spreadsheet_id = os.environ.get("SPREADSHEET_ID")
+    if spreadsheet_id:
+        return spreadsheet_id
     
+    drive = build("drive", "v3", credentials=_google_credentials(), cache_discovery=False)
+    response = drive.files().list(
+        q=(
+            f"name = '{SPREADSHEET_NAME}' and "
+            "mimeType = 'application/vnd.google-apps.spreadsheet' and trashed = false"
+        ),
+        fields="files(id)",
+        pageSize=1,
+        # Include shared drives, where the spreadsheet may live instead of
+        # the service account's own drive
+        supportsAllDrives=True,
+        includeItemsFromAllDrives=True
+    ).execute(num_retries=API_RETRIES)
+    
+    files = response.get("files", [])
+    if not files:
+        raise ValueError(f"Spreadsheet '{SPREADSHEET_NAME}' not found")
+    return files[0]["id"]
+
+
+def _validate_names_remote(names: List[str]) -> Optional[List[str]]:
     names_str = "\n".join([f"{i+1}. {name}" for i, name in enumerate(names)])
     
     prompt = f"""You are a name validator. Given the following list of names from a quiz attendance sheet, identify which ones are REAL person names and which are NOT real names.
@@ -66,9 +169,9 @@ Respond with ONLY a JSON array of the real names. Example: ["John Doe", "Jane Sm
         
         if not api_key:
             print("  No API key found, skipping LLM validation")
-            return names
+            return None
         
-        response = requests.post(
+        response = _HTTP.post(
             "https://ai.hackclub.com/proxy/v1/chat/completions",
             headers={
                 "Authorization": f"Bearer {api_key}",
@@ -97,205 +200,615 @@ Respond with ONLY a JSON array of the real names. Example: ["John Doe", "Jane Sm
             valid_names = json.loads(content)
             return valid_names
         else:
-            print(f"  LLM validation failed (status {response.status_code}), keeping all names")
-            return names
+            print(f"  LLM validation failed (status {response.status_code}), keeping all names that passed the local filter")
+            return None
             
     except Exception as e:
-        print(f"  LLM validation error: {e}, keeping all names")
-        return names
+        print(f"  LLM validation error: {e}, keeping all names that passed the local filter")
+        return None
 
 
+def normalize_key(value: str) -> str:
+    return unicodedata.normalize("NFC", value).casefold().strip()
+
+
+def _llm_cache_key(name: str) -> str:
+    return hashlib.sha256(normalize_key(name).encode("utf-8")).hexdigest()
+
+
+def _load_llm_cache() -> Dict[str, Dict]:
+    if not os.path.exists(LLM_CACHE_PATH):
+        return {}
+    
+    try:
+        with open(LLM_CACHE_PATH, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    
+    return cache if isinstance(cache, dict) else {}
+
+
+def _is_fresh_llm_entry(entry, now: float) -> bool:
+    return (
+        isinstance(entry, dict)
+        and isinstance(entry.get("valid"), bool)
+        and isinstance(entry.get("stored_at"), (int, float))
+        and now - entry["stored_at"] < LLM_CACHE_TTL
+    )
+
+
+def _save_llm_cache(cache: Dict[str, Dict]) -> None:
+    try:
+        with open(LLM_CACHE_PATH, 'w') as f:
+            json.dump(cache, f)
+    except OSError as e:
+        print(f"  Could not write LLM cache: {e}")
+
+
+def _extraction_cache_path(xlsx_file: str) -> str:
+    digest = hashlib.sha256()
+    with open(xlsx_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return os.path.join(
+        EXTRACTION_CACHE_DIR,
+        f"v{EXTRACTION_CACHE_VERSION}-{digest.hexdigest()}.json"
+    )
+
+
+def _load_extraction_cache(cache_path: str) -> Optional[Dict]:
+    if not os.path.exists(cache_path):
+        return None
+    
+    try:
+        with open(cache_path, 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    
+    # Anything that doesn't have the expected shape is treated as a miss and
+    # gets overwritten by a fresh extraction
+    if (not isinstance(data, dict)
+            or not isinstance(data.get("participants"), list)
+            or not isinstance(data.get("quiz_date"), str)
+            or not isinstance(data.get("email_mapping"), dict)):
+        return None
+    if (not all(isinstance(name, str) for name in data["participants"])
+            or not all(isinstance(name, str) and isinstance(email, str)
+                       for name, email in data["email_mapping"].items())):
+        return None
+    return data
+
+
+def _save_extraction_cache(cache_path: str, data: Dict) -> None:
+    try:
+        os.makedirs(EXTRACTION_CACHE_DIR, exist_ok=True)
+        with open(cache_path, 'w') as f:
+            json.dump(data, f)
+    except OSError as e:
+        print(f"  Could not write extraction cache: {e}")
+
+
+def _looks_obviously_fake(name: str) -> bool:
+    stripped = name.strip()
+    return (
+        len(stripped) < 2
+        or not LETTERS_RE.search(stripped)
+        or stripped.lower() in PLACEHOLDER_NAMES
+        or ":" in stripped
+        or "/" in stripped
+        or any(ch.isdigit() for ch in stripped)
+    )
+
+
+def validate_names_with_llm(names: List[str]) -> List[str]:
+    if not names:
+        return []
+    
+    # Obviously fake names are dropped locally; everything else still goes
+    # to the (cached) LLM, since well-formed nonsense like "Lorem Ipsum"
+    # can't be told apart from a real name by its shape
+    candidates = [name for name in names if not _looks_obviously_fake(name)]
+    
+    valid_names = set(_validate_names_cached(candidates))
+    
+    return [name for name in names if name in valid_names]
+
+
+def _validate_names_cached(names: List[str]) -> List[str]:
+    if not names:
+        return []
+    
+    # Decisions are cached per name so a new attendee only costs a lookup
+    # for that one name instead of invalidating the whole list
+    cache = _load_llm_cache()
+    now = time.time()
+    
+    decisions = {}
+    for name in names:
+        entry = cache.get(_llm_cache_key(name))
+        if _is_fresh_llm_entry(entry, now):
+            decisions[name] = entry["valid"]
+    
+    uncached = [name for name in names if name not in decisions]
+    if uncached:
+        if len(uncached) < len(names):
+            print(f"  {len(names) - len(uncached)} names cached, validating {len(uncached)}")
+        valid_names = _validate_names_remote(uncached)
+        
+        if valid_names is not None and not isinstance(valid_names, list):
+            print("  LLM validation returned an unexpected response, keeping all names that passed the local filter")
+            valid_names = None
+        
+        if valid_names is None:
+            return [name for name in names if decisions.get(name, True)]
+        
+        valid_set = {name.strip() for name in valid_names if isinstance(name, str)}
+        for name in uncached:
+            decisions[name] = name.strip() in valid_set
+            cache[_llm_cache_key(name)] = {"valid": decisions[name], "stored_at": now}
+        
+        # Drop expired or malformed entries so the file only holds names
+        # seen within the TTL instead of every name ever validated
+        cache = {key: entry for key, entry in cache.items() if _is_fresh_llm_entry(entry, now)}
+        _save_llm_cache(cache)
+    
+    return [name for name in names if decisions[name]]
+
+
+@functools.lru_cache(maxsize=64)
 def parse_quiz_date(date_string: str) -> str:
     date_part = date_string.split(",")[0].strip()
-    parsed_date = datetime.strptime(date_part, "%a %d %b %Y")
-    return parsed_date.strftime("%Y-%m-%d")
+    
+    match = QUIZ_DATE_RE.fullmatch(date_part)
+    if not match or match.group(2) not in MONTHS:
+        raise ValueError(f"Unrecognized quiz date: {date_string!r}")
+    
+    day, month, year = int(match.group(1)), MONTHS[match.group(2)], int(match.group(3))
+    # Constructing the datetime rejects impossible dates like 31 Feb
+    datetime(year, month, day)
+    
+    return f"{year}-{month:02d}-{day:02d}"
+
+
+def _column_index(cell_ref: str) -> int:
+    col = 0
+    for ch in cell_ref:
+        if not ch.isalpha():
+            break
+        col = col * 26 + (ord(ch.upper()) - ord("A") + 1)
+    return col - 1
 
 
-def extract_participant_data(xlsx_file: str) -> List[str]:
-    df = pd.read_excel(xlsx_file, sheet_name="Participant Data")
+def _text_of(elem) -> str:
+    # Rich text splits a string into runs; phonetic hints (rPh) are not part
+    # of the value
+    return "".join(
+        t.text or ""
+        for t in elem.iter(f"{{{XLSX_NS}}}t")
+        if t.getparent().tag != f"{{{XLSX_NS}}}rPh"
+    )
+
+
+def read_shared_strings(xlsx: zipfile.ZipFile) -> List[str]:
+    if "xl/sharedStrings.xml" not in xlsx.namelist():
+        return []
     
-    participants = []
-    seen_names = set()
+    shared_strings = []
+    with xlsx.open("xl/sharedStrings.xml") as f:
+        for _, si in etree.iterparse(f, events=("end",), tag=f"{{{XLSX_NS}}}si", resolve_entities=False):
+            shared_strings.append(_text_of(si))
+            si.clear()
+    return shared_strings
+
+
+def _sheet_path(xlsx: zipfile.ZipFile, sheet_name: str) -> str:
+    workbook = etree.fromstring(xlsx.read("xl/workbook.xml"), XML_PARSER)
+    rels = etree.fromstring(xlsx.read("xl/_rels/workbook.xml.rels"), XML_PARSER)
     
-    for _, row in df.iterrows():
-        first_name = str(row.get("First Name", "")).strip()
-        last_name = str(row.get("Last Name", "")).strip()
-        
-        if first_name and first_name != "nan":
-            if last_name and last_name != "nan":
-                full_name = f"{first_name} {last_name}"
-            else:
-                full_name = first_name
-            
-            if full_name not in seen_names:
-                participants.append(full_name)
-                seen_names.add(full_name)
+    targets = {
+        rel.get("Id"): rel.get("Target")
+        for rel in rels.iter(f"{{{XLSX_PKG_REL_NS}}}Relationship")
+    }
+    
+    for sheet in workbook.iter(f"{{{XLSX_NS}}}sheet"):
+        if sheet.get("name") == sheet_name:
+            target = targets[sheet.get(f"{{{XLSX_REL_NS}}}id")]
+            return target.lstrip("/") if target.startswith("/") else f"xl/{target}"
+    
+    raise ValueError(f"Could not find '{sheet_name}' sheet in XLSX file")
+
+
+def iter_sheet_rows(
+    xlsx: zipfile.ZipFile,
+    shared_strings: List[str],
+    sheet_name: str
+) -> Iterator[List[Optional[str]]]:
+    # Stream <row> elements and free each one once yielded, so only the
+    # current row is ever held in memory; stopping early skips the rest
+    cell_tag = f"{{{XLSX_NS}}}c"
+    value_tag = f"{{{XLSX_NS}}}v"
+    inline_tag = f"{{{XLSX_NS}}}is"
     
-    return participants
+    with xlsx.open(_sheet_path(xlsx, sheet_name)) as f:
+        for _, row in etree.iterparse(f, events=("end",), tag=f"{{{XLSX_NS}}}row", resolve_entities=False):
+            values = []
+            for position, cell in enumerate(row.iter(cell_tag)):
+                ref = cell.get("r")
+                col = _column_index(ref) if ref else position
+                
+                cell_type = cell.get("t")
+                if cell_type == "inlineStr":
+                    inline = cell.find(inline_tag)
+                    value = _text_of(inline) if inline is not None else None
+                else:
+                    v = cell.find(value_tag)
+                    value = v.text if v is not None else None
+                    if cell_type == "s" and value is not None:
+                        value = shared_strings[int(value)]
+                
+                values.extend([None] * (col + 1 - len(values)))
+                values[col] = value
+            
+            yield values
+            
+            row.clear()
+            while row.getprevious() is not None:
+                del row.getparent()[0]
 
 
-def extract_quiz_date(xlsx_file: str) -> str:
-    df = pd.read_excel(xlsx_file, sheet_name="Quiz Details")
+def _cell_text(row: List[Optional[str]], col: Optional[int]) -> str:
+    if col is None or col >= len(row) or row[col] is None:
+        return ""
+    return str(row[col]).strip()
+
+
+def extract_participant_data(xlsx: zipfile.ZipFile, shared_strings: List[str]) -> List[str]:
+    rows = iter_sheet_rows(xlsx, shared_strings, "Participant Data")
+    headers = next(rows, [])
+    
+    # Only the two name columns are read from each row
+    first_col = headers.index("First Name") if "First Name" in headers else None
+    last_col = headers.index("Last Name") if "Last Name" in headers else None
+    
+    full_names = (
+        f"{_cell_text(row, first_col)} {_cell_text(row, last_col)}".strip()
+        for row in rows
+        if _cell_text(row, first_col)
+    )
     
-    game_started_row = df[df["Name"] == "Game Started On"]
+    # dict.fromkeys drops duplicates while keeping first-seen order
+    return list(dict.fromkeys(full_names))
+
+
+def extract_quiz_date(xlsx: zipfile.ZipFile, shared_strings: List[str]) -> str:
+    rows = iter_sheet_rows(xlsx, shared_strings, "Quiz Details")
+    headers = next(rows, [])
     
-    if game_started_row.empty:
+    if "Name" not in headers or "Value" not in headers:
         raise ValueError("Could not find 'Game Started On' in Quiz Details sheet")
+    name_col = headers.index("Name")
+    value_col = headers.index("Value")
+    
+    for row in rows:
+        if _cell_text(row, name_col) == "Game Started On":
+            return parse_quiz_date(_cell_text(row, value_col))
     
-    date_value = game_started_row.iloc[0]["Value"]
+    raise ValueError("Could not find 'Game Started On' in Quiz Details sheet")
+
+
+def _clean_email(value) -> str:
+    if value is None:
+        return ""
     
-    return parse_quiz_date(date_value)
+    email = str(value).split("<br>")[0].strip()
+    if "@" in email and " " not in email and len(email) > 3:
+        return email
+    return ""
 
 
-def extract_emails(xlsx_file: str) -> Dict[str, str]:
-    df = pd.read_excel(xlsx_file, sheet_name="Overview")
+def extract_emails(xlsx: zipfile.ZipFile, shared_strings: List[str]) -> Dict[str, str]:
+    # The Overview sheet has one column per participant, so stop streaming
+    # as soon as the email question row has been read
+    rows = iter_sheet_rows(xlsx, shared_strings, "Overview")
+    headers = next(rows, [])
+    
+    if "Question" not in headers:
+        raise ValueError("Could not find email question in Overview sheet")
+    question_col = headers.index("Question")
     
-    email_row_idx = None
-    email_pattern = re.compile(r'e[-\s]?mail?', re.IGNORECASE)
-    for idx, row in df.iterrows():
-        question = str(row.get("Question", ""))
-        if email_pattern.search(question):
-            email_row_idx = idx
+    email_row = None
+    for row in rows:
+        question = row[question_col] if question_col < len(row) else None
+        if question is not None and EMAIL_QUESTION_RE.search(str(question)):
+            email_row = row
             break
     
-    if email_row_idx is None:
+    if email_row is None:
         raise ValueError("Could not find email question in Overview sheet")
     
     email_mapping = {}
     
-    for col in df.columns:
-        if col == "Question":
+    for col, header in enumerate(headers):
+        if col == question_col or header is None or col >= len(email_row):
             continue
         
-        match = re.match(r"^(.+?)\s+\(", col)
+        match = PARTICIPANT_COLUMN_RE.match(str(header))
         if match:
-            full_name = match.group(1).strip()
-            
-            email_raw = str(df.at[email_row_idx, col])
-            
-            if "<br>" in email_raw:
-                email = email_raw.split("<br>")[0].strip()
-            else:
-                email = email_raw.strip()
-            
-            if (email and 
-                email != "nan" and 
-                "@" in email and 
-                " " not in email and
-                len(email) > 3):
-                email_mapping[full_name] = email
+            email = _clean_email(email_row[col])
+            if email:
+                email_mapping[match.group(1).strip()] = email
     
     return email_mapping
 
 
-def get_or_create_attendee(
-    sheet: gspread.Worksheet,
-    name: str,
-    email: str
-) -> Optional[int]:
-    import time
+def _column_reader(headers: List[str], header: str) -> Callable[[List[str]], str]:
+    if header not in headers:
+        return lambda row: ""
     
-    all_values = sheet.get_all_values()
+    col = headers.index(header)
+    return lambda row: row[col] if col < len(row) else ""
+
+
+def index_attendees(
+    all_values: List[List[str]]
+) -> Tuple[Dict[str, int], Dict[str, int], Dict[str, int]]:
+    by_email = {}
+    by_name = {}
+    by_name_no_email = {}
     
     if len(all_values) <= 1:
-        records = []
-    else:
-        headers = all_values[0]
-        records = []
-        for row in all_values[1:]:
-            record = {}
-            for i, header in enumerate(headers):
-                record[header] = row[i] if i < len(row) else ""
-            records.append(record)
-    
-    if email:
-        for idx, record in enumerate(records):
-            existing_email = record.get("email", "").strip().lower()
-            if existing_email == email.lower():
-                attendee_id = record.get("id", "").strip()
-                return int(attendee_id) if attendee_id else None
-        
-        name_lower = name.lower().strip()
-        for idx, record in enumerate(records):
-            existing_name = record.get("name", "").strip().lower()
-            existing_email = record.get("email", "").strip()
-            if existing_name == name_lower and not existing_email:
-                row_num = idx + 2
-                sheet.update_cell(row_num, 3, email)
-                time.sleep(0.5)
-                attendee_id = record.get("id", "").strip()
-                return int(attendee_id) if attendee_id else None
+        return by_email, by_name, by_name_no_email
     
-    else:
-        name_lower = name.lower().strip()
-        for record in records:
-            existing_name = record.get("name", "").strip().lower()
-            if existing_name == name_lower:
-                attendee_id = record.get("id", "").strip()
-                return int(attendee_id) if attendee_id else None
+    read_email = _column_reader(all_values[0], "email")
+    read_name = _column_reader(all_values[0], "name")
     
-    sheet.append_row(["", name, email if email else ""])
+    for idx, row in enumerate(all_values[1:]):
+        row_num = idx + 2
+        existing_email = normalize_key(read_email(row))
+        existing_name = normalize_key(read_name(row))
+        
+        if existing_email:
+            by_email.setdefault(existing_email, row_num)
+        else:
+            by_name_no_email.setdefault(existing_name, row_num)
+        by_name.setdefault(existing_name, row_num)
     
-    time.sleep(2)
+    return by_email, by_name, by_name_no_email
+
+
+def attendee_ids_by_row(all_values: List[List[str]]) -> Dict[int, int]:
+    if len(all_values) <= 1:
+        return {}
     
-    all_values = sheet.get_all_values()
+    read_id = _column_reader(all_values[0], "id")
     
-    if len(all_values) <= 1:
+    ids = {}
+    for idx, row in enumerate(all_values[1:]):
+        attendee_id = read_id(row).strip()
+        # Anything but a plain integer (#REF!, 1.0, a note) leaves the row
+        # without an id, so it is reported as failed instead of aborting
+        if attendee_id.isdecimal():
+            ids[idx + 2] = int(attendee_id)
+    return ids
+
+
+def fuzzy_match_attendee(
+    name: str,
+    snapshot_names: Dict[str, int],
+    claimed_rows: Set[int]
+) -> Optional[int]:
+    # Only rows that existed before this run and that no other participant
+    # has resolved to are candidates: names within one export are distinct
+    # people, so they must never be merged with each other
+    choices = [key for key, row_num in snapshot_names.items() if row_num not in claimed_rows]
+    if not choices:
         return None
     
-    headers = all_values[0]
-    last_row = all_values[-1]
-    last_record = {}
-    for i, header in enumerate(headers):
-        last_record[header] = last_row[i] if i < len(last_row) else ""
+    match = process.extractOne(
+        normalize_key(name),
+        choices,
+        scorer=fuzz.WRatio,
+        processor=utils.default_process,
+        score_cutoff=FUZZY_NAME_CUTOFF
+    )
+    return snapshot_names[match[0]] if match else None
+
+
+def get_or_create_attendee(
+    by_email: Dict[str, int],
+    by_name: Dict[str, int],
+    by_name_no_email: Dict[str, int],
+    next_row: int,
+    new_id: int,
+    name: str,
+    email: str
+) -> Tuple[int, Optional[List], Optional[Tuple[int, str]]]:
+    email_key = normalize_key(email) if email else ""
+    
+    # An email hit settles it, before any work on the name
+    if email_key in by_email:
+        return by_email[email_key], None, None
     
-    attendee_id = last_record.get("id", "").strip()
+    name_key = normalize_key(name)
     
-    if not attendee_id:
-        time.sleep(2)
-        all_values = sheet.get_all_values()
-        last_row = all_values[-1]
-        for i, header in enumerate(headers):
-            last_record[header] = last_row[i] if i < len(last_row) else ""
-        attendee_id = last_record.get("id", "").strip()
+    if email_key:
+        if name_key in by_name_no_email:
+            row_num = by_name_no_email.pop(name_key)
+            by_email[email_key] = row_num
+            return row_num, None, (row_num, email)
     
-    return int(attendee_id) if attendee_id else None
+    elif name_key in by_name:
+        return by_name[name_key], None, None
+    
+    row_num = next_row
+    if email_key:
+        by_email[email_key] = row_num
+    else:
+        by_name_no_email.setdefault(name_key, row_num)
+    by_name.setdefault(name_key, row_num)
+    
+    return row_num, [new_id, name, email if email else ""], None
 
 
-def create_session(
-    sheet: gspread.Worksheet,
-    url: str,
-    title: str,
-    date: str
-) -> Optional[int]:
-    import time
+def connect_sheets() -> Tuple[str, Dict[str, int], Dict[str, List[List[str]]]]:
+    spreadsheet_id = find_spreadsheet_id()
     
-    sheet.append_row(["", url, title, date])
+    # Writing client-assigned ids over a formula column would corrupt it,
+    # so refuse before anything is resolved or confirmed
+    formula_sheets = read_formula_id_sheets(spreadsheet_id)
+    if formula_sheets:
+        raise RuntimeError(
+            f"id column in {', '.join(formula_sheets)} is generated by a formula; "
+            "run 'python process_attendance.py --migrate-ids' once to "
+            "replace the formulas with values"
+        )
     
-    time.sleep(2)
+    return spreadsheet_id, read_sheet_ids(spreadsheet_id), read_sheets(spreadsheet_id)
+
+
+def read_formula_id_sheets(spreadsheet_id: str) -> List[str]:
+    formulas = setup_google_sheets().spreadsheets().values().batchGet(
+        spreadsheetId=spreadsheet_id, ranges=ID_RANGES, valueRenderOption="FORMULA"
+    ).execute(num_retries=API_RETRIES).get("valueRanges", [])
     
-    all_values = sheet.get_all_values()
-    if len(all_values) > 1:
-        last_row = all_values[-1]
-        session_id = last_row[0].strip() if last_row and last_row[0] else None
-        
-        if not session_id:
-            time.sleep(2)
-            all_values = sheet.get_all_values()
-            last_row = all_values[-1]
-            session_id = last_row[0].strip() if last_row and last_row[0] else None
-        
-        return int(session_id) if session_id else None
+    return [
+        id_range.split("!")[0]
+        for id_range, formula_range in zip(ID_RANGES, formulas)
+        if _column_has_formula(formula_range.get("values", []))
+    ]
+
+
+def _column_has_formula(column: List[List[str]]) -> bool:
+    return any(row and str(row[0]).startswith("=") for row in column)
+
+
+def read_sheet_ids(spreadsheet_id: str) -> Dict[str, int]:
+    metadata = setup_google_sheets().spreadsheets().get(
+        spreadsheetId=spreadsheet_id,
+        fields="sheets.properties(sheetId,title)"
+    ).execute(num_retries=API_RETRIES)
+    return {
+        sheet["properties"]["title"]: sheet["properties"]["sheetId"]
+        for sheet in metadata.get("sheets", [])
+    }
+
+
+def read_sheets(spreadsheet_id: str) -> Dict[str, List[List[str]]]:
+    response = setup_google_sheets().spreadsheets().values().batchGet(
+        spreadsheetId=spreadsheet_id,
+        ranges=list(SHEET_RANGES.values())
+    ).execute(num_retries=API_RETRIES)
+    value_ranges = response.get("valueRanges", [])
     
-    return None
+    return {
+        sheet_name: value_range.get("values", [])
+        for sheet_name, value_range in zip(SHEET_RANGES, value_ranges)
+    }
 
 
-def log_attendance(
-    sheet: gspread.Worksheet,
-    member_id: int,
-    session_id: int
+def next_id(all_values: List[List[str]]) -> int:
+    existing_ids = (
+        int(row[0].strip())
+        for row in all_values[1:]
+        if row and row[0].strip().isdecimal()
+    )
+    return max(existing_ids, default=0) + 1
+
+
+def _cell(value) -> Dict:
+    if value == "" or value is None:
+        return {}
+    if isinstance(value, (int, float)):
+        return {"userEnteredValue": {"numberValue": value}}
+    return {"userEnteredValue": {"stringValue": str(value)}}
+
+
+def _append_cells(sheet_id: int, rows: List[List]) -> Dict:
+    return {
+        "appendCells": {
+            "sheetId": sheet_id,
+            "rows": [{"values": [_cell(value) for value in row]} for row in rows],
+            "fields": "userEnteredValue"
+        }
+    }
+
+
+def write_updates(
+    spreadsheet_id: str,
+    sheet_ids: Dict[str, int],
+    session_row: List,
+    pending_appends: List[List],
+    pending_email_patches: List[Tuple[int, str]],
+    pending_logs: List[List[int]]
 ) -> None:
-    sheet.append_row([member_id, session_id])
+    # Everything goes out as one spreadsheets.batchUpdate, which Sheets
+    # applies atomically and in order; appendCells also grows the grid when
+    # needed. Appends go first so a patch can never land on an empty row
+    # that an append is about to fill.
+    requests_body = [_append_cells(sheet_ids[SHEET_SESSIONS], [session_row])]
+    if pending_appends:
+        requests_body.append(_append_cells(sheet_ids[SHEET_ATTENDEES], pending_appends))
+    if pending_logs:
+        requests_body.append(_append_cells(sheet_ids[SHEET_ATTENDANCE_LOG], pending_logs))
+    
+    requests_body.extend(
+        {
+            "updateCells": {
+                "range": {
+                    "sheetId": sheet_ids[SHEET_ATTENDEES],
+                    "startRowIndex": row_num - 1,
+                    "endRowIndex": row_num,
+                    "startColumnIndex": 2,
+                    "endColumnIndex": 3
+                },
+                "rows": [{"values": [_cell(email)]}],
+                "fields": "userEnteredValue"
+            }
+        }
+        for row_num, email in pending_email_patches
+    )
+    
+    # Not retried: appendCells is not idempotent, so a retry after a 5xx
+    # that was actually applied would duplicate every row
+    setup_google_sheets().spreadsheets().batchUpdate(
+        spreadsheetId=spreadsheet_id,
+        body={"requests": requests_body}
+    ).execute()
+
+
+def migrate_id_formulas(spreadsheet_id: str) -> None:
+    # One-time migration for sheets that generate ids with a formula in
+    # column A: freeze the current ids as plain values so client-assigned
+    # ids can be written into that column
+    values_api = setup_google_sheets().spreadsheets().values()
+    
+    formulas = values_api.batchGet(
+        spreadsheetId=spreadsheet_id, ranges=ID_RANGES, valueRenderOption="FORMULA"
+    ).execute(num_retries=API_RETRIES).get("valueRanges", [])
+    values = values_api.batchGet(
+        spreadsheetId=spreadsheet_id, ranges=ID_RANGES, valueRenderOption="UNFORMATTED_VALUE"
+    ).execute(num_retries=API_RETRIES).get("valueRanges", [])
+    
+    data = []
+    for id_range, formula_range, value_range in zip(ID_RANGES, formulas, values):
+        column = value_range.get("values", [])
+        if _column_has_formula(formula_range.get("values", [])) and column:
+            sheet_name = id_range.split("!")[0]
+            data.append({
+                "range": f"{sheet_name}!A1:A{len(column)}",
+                "values": [[row[0] if row else ""] for row in column]
+            })
+            print(f"Replacing id formulas in {sheet_name} with values")
+    
+    if data:
+        values_api.batchUpdate(
+            spreadsheetId=spreadsheet_id,
+            body={"valueInputOption": "RAW", "data": data}
+        ).execute(num_retries=API_RETRIES)
+    else:
+        print("No id formulas found")
 
 
 def main():
@@ -313,46 +826,161 @@ def main():
     print("\nProcessing attendance data...")
     
     try:
-        participants = extract_participant_data(xlsx_file)
-        quiz_date = extract_quiz_date(xlsx_file)
-        email_mapping = extract_emails(xlsx_file)
+        # Reruns on an unchanged export reuse the extracted data; the LLM
+        # decisions for its names are already in the per-name cache
+        cache_path = _extraction_cache_path(xlsx_file)
+        cached = _load_extraction_cache(cache_path)
         
-        print(f"Found {len(participants)} participants")
-        
-        print("\nValidating participant names with LLM...")
-        valid_participants = validate_names_with_llm(participants)
-        filtered_count = len(participants) - len(valid_participants)
-        
-        if filtered_count > 0:
-            print(f"Filtered out {filtered_count} invalid names")
-            filtered_names = set(participants) - set(valid_participants)
-            for name in filtered_names:
-                print(f"  - Removed: {name}")
+        if cached:
+            participants = cached["participants"]
+            quiz_date = cached["quiz_date"]
+            email_mapping = cached["email_mapping"]
+            print("Using cached data for this XLSX file")
+        else:
+            # ZipFile supports concurrent reads of different members, so the
+            # three sheets are streamed in parallel from one open archive
+            with zipfile.ZipFile(xlsx_file) as xlsx, ThreadPoolExecutor(max_workers=3) as executor:
+                shared_strings = read_shared_strings(xlsx)
+                
+                participants_future = executor.submit(extract_participant_data, xlsx, shared_strings)
+                quiz_date_future = executor.submit(extract_quiz_date, xlsx, shared_strings)
+                email_mapping_future = executor.submit(extract_emails, xlsx, shared_strings)
+                
+                participants = participants_future.result()
+                quiz_date = quiz_date_future.result()
+                email_mapping = email_mapping_future.result()
+            
+            _save_extraction_cache(cache_path, {
+                "participants": participants,
+                "quiz_date": quiz_date,
+                "email_mapping": email_mapping
+            })
         
-        participants = valid_participants
-        print(f"{len(participants)} valid participants after filtering")
-        print(f"Quiz date: {quiz_date}")
-        print(f"Found {len(email_mapping)} emails")
+        print(f"Found {len(participants)} participants")
         
     except Exception as e:
         print(f"Error reading XLSX file: {e}")
         return
     
-    # Connect to Google Sheets
-    print("\nConnecting to Google Sheets...")
-    try:
-        client = setup_google_sheets()
-        spreadsheet = client.open(SPREADSHEET_NAME)
+    # Validate names and connect to Google Sheets in parallel; the two are
+    # independent until the summary below
+    print("\nValidating participant names with LLM...")
+    print("Connecting to Google Sheets...")
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        llm_future = executor.submit(validate_names_with_llm, participants)
+        sheets_future = executor.submit(connect_sheets)
         
-        attendees_sheet = spreadsheet.worksheet(SHEET_ATTENDEES)
-        sessions_sheet = spreadsheet.worksheet(SHEET_SESSIONS)
-        attendance_log_sheet = spreadsheet.worksheet(SHEET_ATTENDANCE_LOG)
+        try:
+            valid_participants = llm_future.result()
+        except Exception as e:
+            print(f"  LLM validation error: {e}, keeping all names")
+            valid_participants = participants
         
-        print("Connected successfully")
+        try:
+            spreadsheet_id, sheet_ids, sheet_values = sheets_future.result()
+        except Exception as e:
+            print(f"Error connecting to Google Sheets: {e}")
+            return
+    
+    filtered_count = len(participants) - len(valid_participants)
+    
+    if filtered_count > 0:
+        print(f"Filtered out {filtered_count} invalid names")
+        filtered_names = set(participants) - set(valid_participants)
+        for name in filtered_names:
+            print(f"  - Removed: {name}")
+    
+    participants = valid_participants
+    print(f"{len(participants)} valid participants after filtering")
+    print(f"Quiz date: {quiz_date}")
+    print(f"Found {len(email_mapping)} emails")
+    print("Connected successfully")
+    
+    # Resolve attendees against the snapshot read while connecting; this is
+    # all in memory, so it runs before confirmation and can be reviewed
+    print("\nResolving attendees...")
+    
+    attendance_count = 0
+    skipped_count = 0
+    blank_email_count = 0
+    
+    session_id = next_id(sheet_values[SHEET_SESSIONS])
+    attendee_values = sheet_values[SHEET_ATTENDEES]
+    
+    by_email, by_name, by_name_no_email = index_attendees(attendee_values)
+    member_ids = attendee_ids_by_row(attendee_values)
+    snapshot_names = dict(by_name)
+    read_name = _column_reader(attendee_values[0] if attendee_values else [], "name")
+    first_new_row = len(attendee_values) + 1
+    next_row = first_new_row
+    next_attendee_id = next_id(attendee_values)
+    
+    pending_appends = []
+    pending_email_patches = []
+    pending_logs = []
+    logged = []
+    logged_members = set()
+    claimed_rows = set()
+    fuzzy_merges = []
+    
+    for participant_name in participants:
+        # Get email for this participant (or empty string if not found/invalid)
+        email = email_mapping.get(participant_name, "")
         
-    except Exception as e:
-        print(f"Error connecting to Google Sheets: {e}")
-        return
+        if not email:
+            # No valid email found - still create/update attendee with blank email
+            print(f"Processing {participant_name} (no valid email - creating with blank email)")
+        
+        # Without an email, a near-identical name already in the sheet (e.g.
+        # "Rajani K." vs "Rajani K") is reused rather than added again
+        fuzzy_row = None
+        if not email and normalize_key(participant_name) not in by_name:
+            fuzzy_row = fuzzy_match_attendee(participant_name, snapshot_names, claimed_rows)
+        
+        if fuzzy_row:
+            row_num, pending_append, pending_email_patch = fuzzy_row, None, None
+            fuzzy_merges.append((participant_name, read_name(attendee_values[fuzzy_row - 1])))
+        else:
+            row_num, pending_append, pending_email_patch = get_or_create_attendee(
+                by_email,
+                by_name,
+                by_name_no_email,
+                next_row,
+                next_attendee_id,
+                participant_name,
+                email
+            )
+        
+        claimed_rows.add(row_num)
+        
+        if pending_append:
+            pending_appends.append(pending_append)
+            member_ids[next_row] = next_attendee_id
+            next_row += 1
+            next_attendee_id += 1
+        if pending_email_patch:
+            patch_row, patch_email = pending_email_patch
+            if patch_row >= first_new_row:
+                # The row is only being appended in this run, so write the
+                # email as part of it instead of patching a cell
+                pending_appends[patch_row - first_new_row][2] = patch_email
+            else:
+                pending_email_patches.append(pending_email_patch)
+        
+        member_id = member_ids.get(row_num)
+        
+        if not member_id:
+            print(f"Failed to get/create attendee for {participant_name}")
+            skipped_count += 1
+            continue
+        
+        if member_id in logged_members:
+            print(f"Skipping {participant_name} (attendance already logged for this attendee)")
+            continue
+        
+        logged_members.add(member_id)
+        pending_logs.append([member_id, session_id])
+        logged.append((participant_name, email))
     
     # Show summary and ask for confirmation
     print()
@@ -366,10 +994,15 @@ def main():
     print(f"Participants with Emails: {len(email_mapping)}")
     print(f"Participants without Emails: {len(participants) - len(email_mapping)}")
     print()
+    if fuzzy_merges:
+        print("Matched to existing attendees by similar name:")
+        for participant_name, existing_name in fuzzy_merges:
+            print(f"  - {participant_name} -> {existing_name}")
+        print()
     print("This will:")
     print("  1. Create a new session record")
-    print("  2. Add new attendees (if they don't exist)")
-    print(f"  3. Log {len(email_mapping)} attendance records")
+    print(f"  2. Add {len(pending_appends)} new attendees")
+    print(f"  3. Log {len(pending_logs)} attendance records")
     print("=" * 60)
     print()
     
@@ -378,67 +1011,31 @@ def main():
         print("Operation cancelled by user.")
         return
     
-    # Create session
-    print("\nCreating session record...")
+    # Create the session, add/patch attendees and log attendance in one request
+    print("\nWriting session, attendees and attendance...")
     try:
-        session_id = create_session(
-            sessions_sheet,
-            session_url,
-            session_title,
-            quiz_date
+        write_updates(
+            spreadsheet_id,
+            sheet_ids,
+            [session_id, session_url, session_title, quiz_date],
+            pending_appends,
+            pending_email_patches,
+            pending_logs
         )
         
-        if not session_id:
-            print("Failed to create session")
-            return
-        
         print(f"Session created with ID: {session_id}")
         
     except Exception as e:
-        print(f"Error creating session: {e}")
+        print(f"Error updating Google Sheets: {e}")
         return
     
-    # Process attendees and log attendance
-    print("\nProcessing attendees and logging attendance...")
-    
-    attendance_count = 0
-    skipped_count = 0
-    blank_email_count = 0
-    
-    for participant_name in participants:
-        # Get email for this participant (or empty string if not found/invalid)
-        email = email_mapping.get(participant_name, "")
-        
-        if not email:
-            # No valid email found - still create/update attendee with blank email
-            print(f"Processing {participant_name} (no valid email - creating with blank email)")
-        
-        try:
-            # Get or create attendee (with or without email)
-            member_id = get_or_create_attendee(
-                attendees_sheet,
-                participant_name,
-                email
-            )
-            
-            if not member_id:
-                print(f"Failed to get/create attendee for {participant_name}")
-                skipped_count += 1
-                continue
-            
-            # Log attendance
-            log_attendance(attendance_log_sheet, member_id, session_id)
-            
-            if email:
-                attendance_count += 1
-                print(f"Logged attendance for {participant_name}")
-            else:
-                blank_email_count += 1
-                print(f"Logged attendance for {participant_name} (blank email)")
-            
-        except Exception as e:
-            print(f"Error processing {participant_name}: {e}")
-            skipped_count += 1
+    for participant_name, email in logged:
+        if email:
+            attendance_count += 1
+            print(f"Logged attendance for {participant_name}")
+        else:
+            blank_email_count += 1
+            print(f"Logged attendance for {participant_name} (blank email)")
     
     # Summary
     print()
@@ -455,4 +1052,7 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if "--migrate-ids" in sys.argv[1:]:
+        migrate_id_formulas(find_spreadsheet_id())
+    else:
+        main()
\ No newline at end of file